@@ -1,84 +1,104 @@
 # -*- coding: utf-8 -*-
-import argparse, json
+import argparse
 from pathlib import Path
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 
-# 可选：更漂亮的“水滴图钉”，没有则自动降级为蓝色圆图钉
+# 可选：orjson 解析数值数组更快，没有则退回标准库 json
 try:
-    from folium.plugins import BeautifyIcon
-    HAS_BEAUTIFY = True
-except Exception:
-    HAS_BEAUTIFY = False
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+# 中间点在浏览器端生成：Leaflet 默认蓝色“水滴图钉” + tooltip
+# row = [lat, lon, trip_id, idx]
+_MID_CALLBACK = """function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindTooltip("Trip " + row[2] + " — idx " + row[3]);
+    return marker;
+}"""
 
 
 def _parse_polyline(s):
-    """POLYLINE 是 JSON 字符串：[[lon,lat], ...]"""
+    """POLYLINE 是 JSON 字符串：[[lon,lat], ...] -> (M,2) float64 数组"""
     if isinstance(s, str):
         try:
-            coords = json.loads(s)
+            coords = _loads(s)
         except Exception:
             import ast
             coords = ast.literal_eval(s)
     else:
         coords = s
     if not coords:
-        return []
-    # 统一为 (lon, lat) float
-    return [(float(lon), float(lat)) for lon, lat in coords]
+        return np.empty((0, 2))
+    arr = np.asarray(coords, dtype=np.float64)
+    # 必须是 (lon, lat) 两列；不能用 reshape 硬凑形状（3 值的点会被拆成错位的假点）
+    if arr.ndim != 2 or arr.shape[1] != 2:
+        raise ValueError(f"POLYLINE 的点应为 [lon, lat]，实际形状 {arr.shape}")
+    return arr
+
+
+def _read_trips_parquet(path: Path, n: int):
+    """make_trips_parquet.py 的输出 -> 前 n 条 (trip_ids, [(M,2) [lon,lat], ...])，无需 JSON 解析"""
+    table = pq.read_table(path, columns=["trip_id", "lon", "lat"]).slice(0, n)
+    lon = table["lon"].combine_chunks()
+    lat = table["lat"].combine_chunks()
+    offs = lon.offsets.to_numpy()
+    xy = np.column_stack([lon.flatten().to_numpy(), lat.flatten().to_numpy()])
+    return table["trip_id"].to_pylist(), np.split(xy, offs[1:-1] - offs[0])
 
 
 def load_points(csv_file: Path, n: int = 15):
-    """读取前 n 条轨迹 -> 点列表 + 轨迹列表"""
-    df = pd.read_csv(csv_file, dtype={"TRIP_ID": str}).head(n).copy()
-
-    points = []
-    trajs = []  # [(trip_id, [(lon,lat), ...]), ...]
-    for i, row in df.iterrows():
-        coords = _parse_polyline(row["POLYLINE"])
-        if not coords:
-            continue
-        trip_id = row.get("TRIP_ID", f"traj_{i}")
-        trajs.append((trip_id, coords))
-        L = len(coords)
-        for k, (lon, lat) in enumerate(coords):
-            points.append(
-                {
-                    "trip_id": trip_id,
-                    "idx": k,
-                    "lat": lat,
-                    "lon": lon,
-                    "is_start": k == 0,
-                    "is_end": k == L - 1,
-                }
-            )
-    if not points:
+    """读取前 n 条轨迹（CSV 或预处理好的 .parquet）-> 点（SoA 数组字典）+ 轨迹列表"""
+    if csv_file.suffix.lower() == ".parquet":
+        ids, arrs = _read_trips_parquet(csv_file, n)
+    else:
+        table = pacsv.read_csv(csv_file, convert_options=pacsv.ConvertOptions(
+            include_columns=["TRIP_ID", "POLYLINE"], include_missing_columns=True,
+            column_types={"TRIP_ID": pa.string(), "POLYLINE": pa.string()}))
+        df = table.slice(0, n).to_pandas()
+        ids = df["TRIP_ID"].tolist()
+        arrs = [_parse_polyline(s) for s in df["POLYLINE"].to_numpy()]
+    # 两种输入同样处理：没有 TRIP_ID（列缺失、空值或空串）时用 traj_{行号}
+    ids = [tid if isinstance(tid, str) and tid else f"traj_{i}" for i, tid in enumerate(ids)]
+
+    trajs = [(tid, arr) for tid, arr in zip(ids, arrs) if arr.size]  # [(trip_id, (M,2) [lon,lat]), ...]
+    if not trajs:
         raise RuntimeError("没有有效轨迹点。")
+
+    # 结构数组（SoA）：总点数先算好，一次分配缓冲区，再按轨迹顺序原地拼接
+    sizes = np.fromiter((len(arr) for _, arr in trajs), dtype=np.int64, count=len(trajs))
+    total = int(sizes.sum())
+    coords = np.empty((total, 2), dtype=np.float64)
+    np.concatenate([arr for _, arr in trajs], out=coords)
+    trip = np.repeat(np.arange(len(trajs)), sizes)   # 每个点所属轨迹的下标
+    idx = np.arange(total) - (np.cumsum(sizes) - sizes)[trip]
+    points = {
+        "trip_id": np.array([tid for tid, _ in trajs], dtype=object)[trip],
+        "idx": idx,
+        "lon": coords[:, 0],
+        "lat": coords[:, 1],
+        "is_start": idx == 0,
+        "is_end": idx == (sizes - 1)[trip],
+    }
     return points, trajs
 
 
 def _bounds_from_points(points):
-    lats = [p["lat"] for p in points]
-    lons = [p["lon"] for p in points]
-    pad_lat = (max(lats) - min(lats)) * 0.05 or 0.001
-    pad_lon = (max(lons) - min(lons)) * 0.05 or 0.001
+    lats, lons = points["lat"], points["lon"]
+    lat_min, lat_max = float(lats.min()), float(lats.max())
+    lon_min, lon_max = float(lons.min()), float(lons.max())
+    pad_lat = (lat_max - lat_min) * 0.05 or 0.001
+    pad_lon = (lon_max - lon_min) * 0.05 or 0.001
     # Leaflet 的 fitBounds 是 [[south, west], [north, east]]
-    return [[min(lats) - pad_lat, min(lons) - pad_lon],
-            [max(lats) + pad_lat, max(lons) + pad_lon]]
-
-
-def _icon_blue_pin():
-    if HAS_BEAUTIFY:
-        return BeautifyIcon(
-            icon_shape="marker",
-            border_color="#1B4F72",
-            border_width=1,
-            text_color="white",
-            background_color="#2E86DE",
-        )
-    else:
-        return folium.Icon(color="blue", icon="info-sign")  # 基础圆图钉
+    return [[lat_min - pad_lat, lon_min - pad_lon],
+            [lat_max + pad_lat, lon_max + pad_lon]]
 
 
 def _icon_taxi():
@@ -91,9 +111,14 @@ def _icon_flag():
     return folium.Icon(color="red", icon="flag-checkered", prefix="fa")
 
 
+# folium ≥0.19 的 Marker 可以共用同一个 Icon 实例（图标 JS 只输出一次，每个标记只剩一句 setIcon）；
+# 旧版（readme 固定的 0.17）Icon 的 setIcon 绑在唯一的 _parent 上，共用会全部落到最后一个标记，只能各建一个
+_SHARED_ICONS = hasattr(folium.Marker, "SetIcon")
+
+
 def build_map(points, trajs, out_html: Path, draw_lines=True, add_stamen=False):
     # 初始中心（稍后用 fit_bounds 精准适配）
-    m = folium.Map(location=[points[0]["lat"], points[0]["lon"]],
+    m = folium.Map(location=[points["lat"][0], points["lon"][0]],
                    zoom_start=12, tiles=None)
 
     # —— 底图（全部带 attribution，合规不报错） ——
@@ -117,42 +142,53 @@ def build_map(points, trajs, out_html: Path, draw_lines=True, add_stamen=False):
             attr="Map tiles by Stamen Design, CC BY 3.0 — Map data © OpenStreetMap contributors",
         ).add_to(m)
 
-    # —— 图层：起点/终点/中间点（聚合） ——
+    # —— 图层：起点/终点（真实 Marker，图标各异）/中间点（一次性 JSON 数组聚合） ——
     layer_starts = folium.FeatureGroup(name="Start (Taxi)", show=True)
     layer_ends   = folium.FeatureGroup(name="End (Flag)", show=True)
-    cluster_mids = MarkerCluster(
-        name="Intermediate Points", show=True, disableClusteringAtZoom=15
-    )
 
-    # 点标注
-    for p in points:
-        pt = (p["lat"], p["lon"])
-        if p["is_start"]:
-            folium.Marker(pt, icon=_icon_taxi(),
-                          tooltip=f"Trip {p['trip_id']} — START").add_to(layer_starts)
-        elif p["is_end"]:
-            folium.Marker(pt, icon=_icon_flag(),
-                          tooltip=f"Trip {p['trip_id']} — END").add_to(layer_ends)
+    # 起终点只有 ≤ 2·len(trajs) 个；图标每种只建一次
+    icon_taxi = _icon_taxi() if _SHARED_ICONS else None
+    icon_flag = _icon_flag() if _SHARED_ICONS else None
+    for arr_i in np.flatnonzero(points["is_start"] | points["is_end"]).tolist():
+        pt = (float(points["lat"][arr_i]), float(points["lon"][arr_i]))
+        trip_id = points["trip_id"][arr_i]
+        if points["is_start"][arr_i]:
+            folium.Marker(pt, icon=icon_taxi or _icon_taxi(),
+                          tooltip=f"Trip {trip_id} — START").add_to(layer_starts)
         else:
-            folium.Marker(pt, icon=_icon_blue_pin(),
-                          tooltip=f"Trip {p['trip_id']} — idx {p['idx']}").add_to(cluster_mids)
+            folium.Marker(pt, icon=icon_flag or _icon_flag(),
+                          tooltip=f"Trip {trip_id} — END").add_to(layer_ends)
+
+    mid = ~(points["is_start"] | points["is_end"])
+    mids_data = [list(r) for r in zip(points["lat"][mid].tolist(), points["lon"][mid].tolist(),
+                                      points["trip_id"][mid].tolist(), points["idx"][mid].tolist())]
+    cluster_mids = FastMarkerCluster(
+        mids_data, callback=_MID_CALLBACK,
+        name="Intermediate Points", show=True, disableClusteringAtZoom=15
+    )
 
     layer_starts.add_to(m)
     layer_ends.add_to(m)
     cluster_mids.add_to(m)
 
-    # 轨迹折线（可关）
+    # 轨迹折线（可关）：整体一个 GeoJSON 图层，颜色放在 properties 里
     if draw_lines:
         from itertools import cycle
         colors = cycle([
             "#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
             "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"
         ])
-        layer_lines = folium.FeatureGroup(name="Trajectories", show=True)
-        for trip_id, coords in trajs:
-            latlons = [(lat, lon) for (lon, lat) in coords]
-            folium.PolyLine(latlons, color=next(colors), weight=3, opacity=0.7).add_to(layer_lines)
-        layer_lines.add_to(m)
+        fc = {"type": "FeatureCollection", "features": [
+            {"type": "Feature",
+             "geometry": {"type": "LineString", "coordinates": coords.tolist()},
+             "properties": {"trip_id": str(trip_id), "color": next(colors)}}
+            for trip_id, coords in trajs
+        ]}
+        folium.GeoJson(
+            fc, name="Trajectories", show=True,
+            style_function=lambda f: {"color": f["properties"]["color"],
+                                      "weight": 3, "opacity": 0.7},
+        ).add_to(m)
 
     # 控件 & 视野
     folium.LayerControl(collapsed=False, position="topleft").add_to(m)
@@ -165,7 +201,8 @@ def build_map(points, trajs, out_html: Path, draw_lines=True, add_stamen=False):
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--csv", type=Path, required=True, help="CSV 路径（含 POLYLINE 列）")
+    ap.add_argument("--csv", type=Path, required=True,
+                    help="CSV 路径（含 POLYLINE 列），或 make_trips_parquet.py 生成的 .parquet")
     ap.add_argument("--out", type=Path, default=Path("porto_markers.html"))
     ap.add_argument("--n", type=int, default=15, help="取前 n 条轨迹")
     ap.add_argument("--no-lines", action="store_true", help="不画折线")
@@ -13,7 +13,7 @@ def ensure_proj():
 ensure_proj()
 
 import osmnx as ox
-import geopandas as gpd
+import pyogrio
 
 OUT = Path("edges.shp")
 
@@ -25,5 +25,5 @@ edges = ox.graph_to_gdfs(G, nodes=False, edges=True).reset_index()
 edges = edges.rename(columns={"u": "source", "v": "target"})
 edges["id"] = range(len(edges))
 
-edges[["id", "source", "target", "geometry"]].to_file(OUT)
+pyogrio.write_dataframe(edges[["id", "source", "target", "geometry"]], str(OUT))
 print("Wrote", OUT.resolve(), "edges:", len(edges))
@@ -1,50 +1,112 @@
 # build_trips_15_strict.py
-import json, csv, math
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+# 可选：orjson 解析数值数组更快，没有则退回标准库 json
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
 
 SRC = Path("train-1500.csv")     # 原始数据
+PARQUET = Path("trips.parquet")  # make_trips_parquet.py 的输出；存在就优先用，免去 JSON 解析
 OUT = Path("trips.csv") # 只含前15条、严格校验
 
+# 可选：有 numba 就 JIT 编译校验循环，没有则退化为普通 Python 函数
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+@njit(cache=True)
+def clean_coords(a):
+    # (M,2) [lon,lat]：去掉非有限值/越界点，再去重相邻重复点
+    n = a.shape[0]
+    out = np.empty_like(a)
+    k = 0
+    for i in range(n):
+        lon = a[i, 0]; lat = a[i, 1]
+        if not (np.isfinite(lon) and np.isfinite(lat)):
+            continue
+        if lon < -180 or lon > 180 or lat < -90 or lat > 90:
+            continue
+        if k > 0 and out[k - 1, 0] == lon and out[k - 1, 1] == lat:
+            continue
+        out[k, 0] = lon; out[k, 1] = lat
+        k += 1
+    return out[:k]
+
+def _as_array(pts):
+    # 常规情况一次转成 (M,2)；形状不规整时才逐点挑出合法的 [lon,lat]
+    try:
+        arr = np.asarray(pts, dtype=np.float64)
+    except (TypeError, ValueError):
+        arr = None
+    if arr is None or arr.ndim != 2 or arr.shape[1] != 2:
+        ok = [it for it in pts
+              if isinstance(it, (list, tuple)) and len(it) == 2
+              and all(isinstance(v, (int, float)) for v in it)]
+        arr = np.asarray(ok, dtype=np.float64).reshape(-1, 2)
+    return np.ascontiguousarray(arr)
+
 def to_wkt(poly):
-    # 解析 POLYLINE 为 [(lon,lat), ...]，逐点校验
-    if isinstance(poly, str):
-        try:
-            pts = json.loads(poly)
-        except Exception:
-            import ast; pts = ast.literal_eval(poly)
+    # 解析 POLYLINE 为 (M,2) 数组，逐点校验（Parquet 读出的已经是数组）
+    if isinstance(poly, np.ndarray):
+        arr = np.ascontiguousarray(poly, dtype=np.float64)
     else:
-        pts = poly
-    ok = []
-    for it in pts:
-        if isinstance(it, (list, tuple)) and len(it) == 2:
-            lon, lat = it
-            if all(isinstance(v, (int, float)) and math.isfinite(v) for v in (lon, lat)) \
-               and -180 <= float(lon) <= 180 and -90 <= float(lat) <= 90:
-                ok.append((float(lon), float(lat)))
-    # 去重相邻重复点
-    dedup = []
-    for xy in ok:
-        if not dedup or xy != dedup[-1]:
-            dedup.append(xy)
+        if isinstance(poly, str):
+            try:
+                pts = _loads(poly)
+            except Exception:
+                import ast; pts = ast.literal_eval(poly)
+        else:
+            pts = poly
+        arr = _as_array(pts or [])
+    dedup = clean_coords(arr)
     if len(dedup) < 2:
         return None
-    return "LINESTRING(" + ",".join(f"{lon:.6f} {lat:.6f}" for lon, lat in dedup) + ")"
+    # 一次 % 格式化整条线（C 层完成），代替逐点 f-string 再 join
+    body = ",".join(["%.6f %.6f"] * len(dedup)) % tuple(dedup.ravel().tolist())
+    return "LINESTRING(" + body + ")"
+
+def read_polylines():
+    # trips.parquet 比 train-1500.csv 旧（CSV 更新过）就不用，免得悄悄用过期数据
+    if PARQUET.exists() and (not SRC.exists() or PARQUET.stat().st_mtime >= SRC.stat().st_mtime):
+        print("Reading", PARQUET.resolve())
+        table = pq.read_table(PARQUET, columns=["lon", "lat"])
+        lon = table["lon"].combine_chunks()
+        lat = table["lat"].combine_chunks()
+        offs = lon.offsets.to_numpy()
+        xy = np.column_stack([lon.flatten().to_numpy(), lat.flatten().to_numpy()])
+        return np.split(xy, offs[1:-1] - offs[0])
+    if PARQUET.exists():
+        print(f"{PARQUET} 比 {SRC} 旧，已忽略；请重新运行 make_trips_parquet.py")
+    print("Reading", SRC.resolve())
+    return pd.read_csv(SRC)["POLYLINE"].tolist()
 
-df = pd.read_csv(SRC)
 rows = []
-for i, s in enumerate(df["POLYLINE"].tolist()):
+for i, s in enumerate(read_polylines()):
     w = to_wkt(s)
     if w:
         rows.append({"id": i, "geom": w})
     if len(rows) == 1500:
         break
 
-with OUT.open("w", newline="", encoding="utf-8") as f:
-    # 关键修改：用 QUOTE_MINIMAL，表头不会被加引号；分隔符为 ;
-    writer = csv.writer(f, delimiter=";", quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
-    writer.writerow(["id", "geom"])   # 表头 => id;geom
-    for r in rows:
-        writer.writerow([r["id"], r["geom"]])
+with OUT.open("wb") as f:
+    # 表头手写（pyarrow 会给表头加引号，FMM 不认）=> id;geom
+    f.write(b"id;geom\n")
+    # 数据行：WKT 里没有 ; 和引号，无需 quoting；pyarrow 直接从缓冲区写 UTF-8
+    table = pa.table({"id": [r["id"] for r in rows], "geom": [r["geom"] for r in rows]})
+    pacsv.write_csv(table, f, write_options=pacsv.WriteOptions(
+        include_header=False, delimiter=";", quoting_style="none"))
 
 print("Wrote", OUT.resolve(), "rows:", len(rows))
@@ -1,91 +1,124 @@
 # 04_post_stmatch_view.py
 # -*- coding: utf-8 -*-
-import argparse, json, re
+import argparse, csv, re
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from shapely import wkt
-from shapely.geometry import LineString, MultiLineString, mapping
-import folium
-
-def sniff_sep(csv_path: Path) -> str:
-    with open(csv_path, "r", encoding="utf-8", errors="ignore") as f:
-        head = f.readline()
-    if ";" in head and "," not in head: return ";"
-    if "," in head and ";" not in head: return ","
-    # 两个都有时，多数是逗号
-    return ","
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import shapely
+import geopandas as gpd
+import pyogrio
+import jinja2
+
+# 可选：orjson 序列化更快，没有则退回标准库 json
+try:
+    import orjson
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    import json
+    def _dumps(obj) -> str:
+        return json.dumps(obj)
+
+# 总览图直接用 Jinja 模板 + Leaflet 的 L.geoJSON 渲染，不再构建 folium 对象树
+_TEMPLATE = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(str(Path(__file__).resolve().parent))
+).get_template("map_template.html.j2")
+TILES_URL = "https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}{r}.png"
+TILES_ATTR = "© OpenStreetMap contributors, © CARTO"
+
+def render_map(fc: dict, bounds, out_html: Path, title: str, layer_control=False,
+               weight=3, opacity=0.85):
+    html = _TEMPLATE.render(
+        title=title, center=[41.15, -8.61], zoom=12,   # 默认波尔图中心；有边界就 fit_bounds
+        tiles_url=TILES_URL, attr=TILES_ATTR,
+        geojson=_dumps(fc).replace("</", "<\\/"),      # 防止属性里的 </script> 截断脚本
+        bounds=bounds, layer_control=layer_control, weight=weight, opacity=opacity)
+    Path(out_html).write_text(html, encoding="utf-8")
+
+_SNIFF_BYTES = 64 * 1024
+
+def sniff_sep(sample) -> str:
+    """在文件前 64 KB 上用 csv.Sniffer 判断分隔符；判断不了时按表头规则"""
+    text = bytes(sample[:_SNIFF_BYTES]).decode("utf-8", "ignore")
+    try:
+        return csv.Sniffer().sniff(text, delimiters=",;|\t").delimiter
+    except csv.Error:
+        head = text.split("\n", 1)[0]
+        if ";" in head and "," not in head: return ";"
+        return ","  # 两个都有时，多数是逗号
+
+_STR_COLS = {c: pa.string() for c in ("mgeom", "cpath", "opath", "error")}
 
 def load_matched(csv_path: Path) -> pd.DataFrame:
-    sep = sniff_sep(csv_path)
-    df = pd.read_csv(csv_path, sep=sep, engine="python")
-    df.columns = [str(c).strip().strip('"').strip("'") for c in df.columns]
+    # 文件只映射一次：嗅探分隔符和 Arrow 解析共用同一块 mmap，不再二次打开/拷贝
+    # Arrow 的 C++ 解析器会去掉表头引号；路径/几何列统一按字符串读
+    with pa.memory_map(str(csv_path)) as src:
+        sep = sniff_sep(src.read_at(min(_SNIFF_BYTES, src.size()), 0))
+        table = pacsv.read_csv(src, parse_options=pacsv.ParseOptions(delimiter=sep),
+                               convert_options=pacsv.ConvertOptions(column_types=_STR_COLS))
+    df = table.to_pandas()
     if "mgeom" not in df.columns:
         raise ValueError(f"'mgeom' column not found. Columns = {df.columns.tolist()}")
     return df
 
 _fix_tail_comma = re.compile(r',\s*\)')   # 把 ", )" 修成 ")"
 
-def parse_geom_safe(wkt_text: str):
-    if not isinstance(wkt_text, str): return None
-    s = wkt_text.strip().strip('"').strip("'")
-    if not s or s.upper().endswith("EMPTY"):  # LINESTRING EMPTY 直接跳过
-        return None
-    # 尝试原样解析
-    try:
-        return wkt.loads(s)
-    except Exception:
-        # 修补常见坏格式：末尾多逗号，如 "LINESTRING(..., )"
-        s2 = _fix_tail_comma.sub(")", s)
-        if s2 != s:
-            try:
-                return wkt.loads(s2)
-            except Exception:
-                return None
-        return None
-
-def df_to_geojson(df: pd.DataFrame) -> (dict, int, int, list):
-    feats, ok, bad = [], 0, 0
-    bounds = []  # 用于 fit_bounds
-    for _, r in df.iterrows():
-        g = parse_geom_safe(str(r.get("mgeom", "")))
-        if g is None:
-            bad += 1
-            continue
-        props = {k: r[k] for k in df.columns if k != "mgeom"}
-        if isinstance(g, LineString):
-            feats.append({"type":"Feature","geometry":mapping(g),"properties":props})
-            bounds.extend(list(g.coords))
-        elif isinstance(g, MultiLineString):
-            for seg in g.geoms:
-                feats.append({"type":"Feature","geometry":mapping(seg),"properties":props})
-                bounds.extend(list(seg.coords))
-        else:
-            # 其他几何类型很少见，忽略
-            bad += 1
-            continue
-        ok += 1
-    fc = {"type":"FeatureCollection","features":feats}
-    return fc, ok, bad, bounds
-
-def make_map(geojson_fc: dict, bounds_xy, out_html: Path):
-    # 默认波尔图中心；有边界就 fit_bounds
-    m = folium.Map(location=[41.15, -8.61], zoom_start=12,
-                   tiles="CartoDB positron",
-                   attr="© OpenStreetMap contributors, © CARTO")
-    for f in geojson_fc["features"]:
-        g = f["geometry"]
-        if g["type"] == "LineString":
-            coords = [(lat, lon) for lon, lat in g["coordinates"]]
-            folium.PolyLine(coords, weight=3, opacity=0.85).add_to(m)
-        elif g["type"] == "MultiLineString":
-            for line in g["coordinates"]:
-                coords = [(lat, lon) for lon, lat in line]
-                folium.PolyLine(coords, weight=3, opacity=0.85).add_to(m)
-    if bounds_xy:
-        lats = [lat for (lon, lat) in bounds_xy]
-        lons = [lon for (lon, lat) in bounds_xy]
-        m.fit_bounds([[min(lats), min(lons)], [max(lats), max(lons)]])
-    m.save(str(out_html))
+def parse_geoms(wkts) -> np.ndarray:
+    """批量解析 WKT -> shapely 几何数组；坏格式/EMPTY 置为 None"""
+    s = pd.Series(wkts, dtype=object).fillna("").astype(str).str.strip().str.strip('"').str.strip("'")
+    arr = s.to_numpy(dtype=object)
+    # 先原样解析
+    geoms = shapely.from_wkt(arr, on_invalid="ignore")
+    # 只对解析失败的少数行修补常见坏格式：末尾多逗号，如 "LINESTRING(..., )"
+    bad = shapely.is_missing(geoms)
+    if bad.any():
+        fixed = [_fix_tail_comma.sub(")", w) for w in arr[bad]]
+        geoms[bad] = shapely.from_wkt(np.array(fixed, dtype=object), on_invalid="ignore")
+    geoms[shapely.is_empty(geoms)] = None   # LINESTRING EMPTY 直接跳过
+    return geoms
+
+def df_to_gdf(df: pd.DataFrame) -> (gpd.GeoDataFrame, int, int, list):
+    geoms = parse_geoms(df["mgeom"].to_numpy())
+    # 只保留 LineString(1) / MultiLineString(5)，其他几何类型很少见，忽略
+    keep = np.isin(shapely.get_type_id(geoms), (1, 5))
+    ok = int(keep.sum()); bad = len(df) - ok
+
+    # 多段线拆成单段：每段一行，属性取自原行
+    parts, row_idx = shapely.get_parts(geoms[keep], return_index=True)
+    row_idx = np.flatnonzero(keep)[row_idx]
+    props = df.drop(columns="mgeom").iloc[row_idx].reset_index(drop=True)
+    gdf = gpd.GeoDataFrame(props, geometry=parts, crs=4326)
+    coords = shapely.get_coordinates(parts)
+    # 用于 fit_bounds：[[south, west], [north, east]]，一次 min/max 归约
+    bounds = None
+    if len(coords):
+        (xmin, ymin), (xmax, ymax) = coords.min(axis=0), coords.max(axis=0)
+        bounds = [[float(ymin), float(xmin)], [float(ymax), float(xmax)]]
+    return gdf, ok, bad, bounds
+
+def write_geojson(gdf: gpd.GeoDataFrame, path: Path):
+    # GDAL 的 C 写出器直接落盘；.geojsonl/.geojsons 输出按行分隔（GeoJSONSeq），便于流式读取
+    if path.suffix.lower() in (".geojsonl", ".geojsons"):
+        # GeoJSONSeq 不识别 SIGNIFICANT_FIGURES，默认只保留 7 位小数；用 COORDINATE_PRECISION 保住精度
+        pyogrio.write_dataframe(gdf, path, driver="GeoJSONSeq",
+                                layer_options={"COORDINATE_PRECISION": 15})
+    else:
+        pyogrio.write_dataframe(gdf, path, driver="GeoJSON",
+                                layer_options={"SIGNIFICANT_FIGURES": 15, "WRITE_NAME": "NO"})
+
+def make_map(gdf: gpd.GeoDataFrame, bounds, out_html: Path):
+    # 只放几何（属性在 .geojson 里），整体一个 L.geoJSON 图层
+    lines = gdf.geometry.values
+    coords = shapely.get_coordinates(lines)
+    splits = np.cumsum(shapely.get_num_coordinates(lines))[:-1]
+    fc = {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {},
+         "geometry": {"type": "LineString", "coordinates": c.tolist()}}
+        for c in (np.split(coords, splits) if len(coords) else [])
+    ]}
+    render_map(fc, bounds, out_html, title="Matched routes")
 
 def main():
     ap = argparse.ArgumentParser()
@@ -95,9 +128,9 @@ def main():
     args = ap.parse_args()
 
     df = load_matched(args.csv)
-    fc, ok, bad, bounds = df_to_geojson(df)
-    args.geojson.write_text(json.dumps(fc), encoding="utf-8")
-    make_map(fc, bounds, args.html)
+    gdf, ok, bad, bounds = df_to_gdf(df)
+    write_geojson(gdf, args.geojson)
+    make_map(gdf, bounds, args.html)
     print(f"Wrote: {args.geojson} and {args.html}  | parsed={ok}, skipped={bad}")
 
 if __name__ == "__main__":
@@ -1,11 +1,43 @@
 # task4_visualize_routes.py
 # -*- coding: utf-8 -*-
-import argparse, json, re
+import argparse, csv, re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from shapely import wkt
-from shapely.geometry import LineString, MultiLineString, mapping
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import shapely
+import geopandas as gpd
+import pyogrio
 import folium
+import jinja2
+
+# 可选：orjson 序列化更快，没有则退回标准库 json
+try:
+    import orjson
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    import json
+    def _dumps(obj) -> str:
+        return json.dumps(obj)
+
+# 总览图直接用 Jinja 模板 + Leaflet 的 L.geoJSON 渲染，不再构建 folium 对象树
+_TEMPLATE = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(str(Path(__file__).resolve().parent))
+).get_template("map_template.html.j2")
+TILES_URL = "https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}{r}.png"
+TILES_ATTR = "© OpenStreetMap contributors, © CARTO"
+
+def render_map(fc: dict, bounds, out_html: Path, title: str, layer_control=False,
+               weight=3, opacity=0.9):
+    html = _TEMPLATE.render(
+        title=title, center=[41.15, -8.61], zoom=12,   # 默认波尔图中心；有边界就 fit_bounds
+        tiles_url=TILES_URL, attr=TILES_ATTR,
+        geojson=_dumps(fc).replace("</", "<\\/"),      # 防止属性里的 </script> 截断脚本
+        bounds=bounds, layer_control=layer_control, weight=weight, opacity=opacity)
+    Path(out_html).write_text(html, encoding="utf-8")
 
 # 20 色调色板（不依赖 matplotlib）
 PALETTE = [
@@ -15,104 +47,105 @@ PALETTE = [
     "#e5c494","#b3b3b3","#1b9e77","#d95f02","#7570b3"
 ]
 
-def sniff_sep(p: Path) -> str:
-    with open(p, "r", encoding="utf-8", errors="ignore") as f:
-        head = f.readline()
-    if ";" in head and "," not in head: return ";"
-    if "," in head and ";" not in head: return ","
-    return ","  # 两个都有时，多数是逗号
+# 路径/几何列统一按字符串读，避免 Arrow 按首块推断成数值
+_STR_COLS = {c: pa.string() for c in ("mgeom", "cpath", "opath", "error")}
 
-_fix_tail_comma = re.compile(r',\s*\)')  # 修 "..., )"
+_SNIFF_BYTES = 64 * 1024
 
-def parse_geom_safe(s: str):
-    if not isinstance(s, str): return None
-    w = s.strip().strip('"').strip("'")
-    if not w or w.upper().endswith("EMPTY"): return None
+def sniff_sep(sample) -> str:
+    """在文件前 64 KB 上用 csv.Sniffer 判断分隔符；判断不了时按表头规则"""
+    text = bytes(sample[:_SNIFF_BYTES]).decode("utf-8", "ignore")
     try:
-        return wkt.loads(w)
-    except Exception:
-        w2 = _fix_tail_comma.sub(")", w)
-        try:
-            return wkt.loads(w2)
-        except Exception:
-            return None
+        return csv.Sniffer().sniff(text, delimiters=",;|\t").delimiter
+    except csv.Error:
+        head = text.split("\n", 1)[0]
+        if ";" in head and "," not in head: return ";"
+        return ","  # 两个都有时，多数是逗号
+
+_fix_tail_comma = re.compile(r',\s*\)')  # 修 "..., )"
+
+def parse_geoms(wkts) -> np.ndarray:
+    """批量解析 WKT -> shapely 几何数组；坏格式/EMPTY 置为 None"""
+    s = pd.Series(wkts, dtype=object).fillna("").astype(str).str.strip().str.strip('"').str.strip("'")
+    arr = s.to_numpy(dtype=object)
+    geoms = shapely.from_wkt(arr, on_invalid="ignore")
+    # 正则修补只跑在解析失败的行上
+    bad = shapely.is_missing(geoms)
+    if bad.any():
+        fixed = [_fix_tail_comma.sub(")", w) for w in arr[bad]]
+        geoms[bad] = shapely.from_wkt(np.array(fixed, dtype=object), on_invalid="ignore")
+    geoms[shapely.is_empty(geoms)] = None
+    return geoms
 
 def to_features(df: pd.DataFrame):
-    feats, per_route = [], {}
-    for ridx, r in df.iterrows():
-        g = parse_geom_safe(str(r.get("mgeom", "")))
-        if g is None:
-            continue
-        route_id = r.get("id", ridx)  # 输出没携带 id 时用行号
-        props = {k: r[k] for k in df.columns if k != "mgeom"}
-        props["route_id"] = route_id
-        if isinstance(g, LineString):
-            geoms = [g]
-        elif isinstance(g, MultiLineString):
-            geoms = list(g.geoms)
-        else:
-            continue
-        for geom in geoms:
-            feat = {"type":"Feature","geometry":mapping(geom),"properties":props}
-            feats.append(feat)
-            per_route.setdefault(route_id, []).append(feat)
-    return feats, per_route
-
-def draw_feature(f, m, color):
-    g = f["geometry"]
-    if g["type"] == "LineString":
-        coords = [(lat, lon) for lon, lat in g["coordinates"]]
-        folium.PolyLine(coords, weight=3, opacity=0.9, color=color).add_to(m)
-    elif g["type"] == "MultiLineString":
-        for line in g["coordinates"]:
-            coords = [(lat, lon) for lon, lat in line]
-            folium.PolyLine(coords, weight=3, opacity=0.9, color=color).add_to(m)
-
-def make_map(per_route, out_html: Path):
+    geoms = parse_geoms(df["mgeom"].to_numpy())
+    keep = np.isin(shapely.get_type_id(geoms), (1, 5))  # LineString / MultiLineString
+    # 输出没携带 id 时用行号
+    route_ids = df["id"].tolist() if "id" in df.columns else df.index.tolist()
+
+    # 多段线拆成单段：每段一行，属性取自原行
+    parts, row_idx = shapely.get_parts(geoms[keep], return_index=True)
+    row_idx = np.flatnonzero(keep)[row_idx]
+    props = df.drop(columns="mgeom").iloc[row_idx].reset_index(drop=True)
+    props["route_id"] = [route_ids[i] for i in row_idx.tolist()]
+    gdf = gpd.GeoDataFrame(props, geometry=parts, crs=4326)
+    coords, coord_part = shapely.get_coordinates(parts, return_index=True)
+    splits = np.cumsum(shapely.get_num_coordinates(parts))[:-1]
+    # 每条路线的 fit_bounds：[[south, west], [north, east]]，按路线分组做 min/max
+    ext = (pd.DataFrame({"rid": np.asarray(route_ids, dtype=object)[row_idx[coord_part]],
+                         "lon": coords[:, 0], "lat": coords[:, 1]})
+           .groupby("rid", sort=False).agg(["min", "max"]))
+    bounds = {rid: [[r[("lat", "min")], r[("lon", "min")]], [r[("lat", "max")], r[("lon", "max")]]]
+              for rid, r in zip(ext.index.tolist(), ext.to_dict("records"))}
+    # 每条路线 -> 各段的 (K,2) [lon, lat] 数组
+    per_route = {}
+    for i, c in zip(row_idx.tolist(), np.split(coords, splits) if len(coords) else []):
+        per_route.setdefault(route_ids[i], []).append(c)
+    return gdf, per_route, bounds
+
+def write_geojson(gdf: gpd.GeoDataFrame, path: Path):
+    # GDAL 的 C 写出器直接落盘
+    pyogrio.write_dataframe(gdf, path, driver="GeoJSON",
+                            layer_options={"SIGNIFICANT_FIGURES": 15, "WRITE_NAME": "NO"})
+
+def draw_line(line, m, color):
+    # line: (K,2) [lon, lat] -> folium 需要 (lat, lon)
+    folium.PolyLine(line[:, ::-1].tolist(), weight=3, opacity=0.9, color=color).add_to(m)
+
+def make_map(per_route, bounds, out_html: Path):
+    # 每条路线一个 MultiLineString 要素（同色、同名），模板里各自成层并进图层开关
+    feats = []
+    for i, (rid, lines) in enumerate(sorted(per_route.items(), key=lambda x: x[0])):
+        feats.append({"type": "Feature",
+                      "properties": {"name": f"Route {rid}", "color": PALETTE[i % len(PALETTE)]},
+                      "geometry": {"type": "MultiLineString",
+                                   "coordinates": [c.tolist() for c in lines]}})
+    full = None
+    if bounds:
+        b = np.array(list(bounds.values()))  # (R, 2, 2)
+        full = [b[:, 0].min(axis=0).tolist(), b[:, 1].max(axis=0).tolist()]
+    render_map({"type": "FeatureCollection", "features": feats}, full, out_html,
+               title="Matched routes", layer_control=True)
+
+def _save_one_route(rid, lines, color, route_bounds, out_dir: Path):
+    # 在子进程里跑：入参都是 NumPy 数组/list/str，可直接 pickle
     m = folium.Map(location=[41.15,-8.61], zoom_start=12,
                    tiles="CartoDB positron",
                    attr="© OpenStreetMap contributors, © CARTO")
-    bounds = []
-    for i, (rid, feats) in enumerate(sorted(per_route.items(), key=lambda x: x[0])):
-        color = PALETTE[i % len(PALETTE)]
-        layer = folium.FeatureGroup(name=f"Route {rid}", overlay=True, show=True)
-        for f in feats:
-            draw_feature(f, layer, color)
-            geom = f["geometry"]
-            if geom["type"] == "LineString":
-                bounds += geom["coordinates"]
-            elif geom["type"] == "MultiLineString":
-                for line in geom["coordinates"]:
-                    bounds += line
-        layer.add_to(m)
-    if bounds:
-        lats = [lat for (lon, lat) in bounds]
-        lons = [lon for (lon, lat) in bounds]
-        m.fit_bounds([[min(lats), min(lons)], [max(lats), max(lons)]])
-    folium.LayerControl(collapsed=False).add_to(m)
-    m.save(str(out_html))
-
-def save_split_maps(per_route, out_dir: Path):
+    for line in lines:
+        draw_line(line, m, color)
+    if route_bounds:
+        m.fit_bounds(route_bounds)
+    m.save(str(out_dir / f"route_{rid}.html"))
+
+def save_split_maps(per_route, bounds, out_dir: Path, workers=None):
+    # 每张图互相独立（Jinja 渲染 + JSON 拼接，CPU 密集）：按路线分给多个进程
     out_dir.mkdir(parents=True, exist_ok=True)
-    for i, (rid, feats) in enumerate(per_route.items()):
-        m = folium.Map(location=[41.15,-8.61], zoom_start=12,
-                       tiles="CartoDB positron",
-                       attr="© OpenStreetMap contributors, © CARTO")
-        color = PALETTE[i % len(PALETTE)]
-        bounds = []
-        for f in feats:
-            draw_feature(f, m, color)
-            g = f["geometry"]
-            if g["type"] == "LineString":
-                bounds += g["coordinates"]
-            elif g["type"] == "MultiLineString":
-                for line in g["coordinates"]:
-                    bounds += line
-        if bounds:
-            lats = [lat for (lon, lat) in bounds]
-            lons = [lon for (lon, lat) in bounds]
-            m.fit_bounds([[min(lats), min(lons)], [max(lats), max(lons)]])
-        m.save(str(out_dir / f"route_{rid}.html"))
+    rids = list(per_route)
+    colors = [PALETTE[i % len(PALETTE)] for i in range(len(rids))]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(_save_one_route, rids, [per_route[r] for r in rids], colors,
+                    [bounds.get(r) for r in rids], [out_dir] * len(rids)))
 
 def main():
     ap = argparse.ArgumentParser()
@@ -120,25 +153,29 @@ def main():
     ap.add_argument("--out", type=Path, default=Path("routes_all.html"))
     ap.add_argument("--split", action="store_true", help="分别导出每条路线")
     ap.add_argument("--outdir", type=Path, default=Path("routes_split"))
+    ap.add_argument("--workers", type=int, default=None, help="--split 时并行进程数（默认 CPU 核数）")
     args = ap.parse_args()
 
-    sep = sniff_sep(args.csv)
-    df = pd.read_csv(args.csv, sep=sep, engine="python")
-    df.columns = [str(c).strip().strip('"').strip("'") for c in df.columns]
+    # 文件只映射一次：嗅探分隔符和 Arrow 解析共用同一块 mmap
+    with pa.memory_map(str(args.csv)) as src:
+        sep = sniff_sep(src.read_at(min(_SNIFF_BYTES, src.size()), 0))
+        table = pacsv.read_csv(src, parse_options=pacsv.ParseOptions(delimiter=sep),
+                               convert_options=pacsv.ConvertOptions(column_types=_STR_COLS))
+    df = table.to_pandas()
+    df.columns = [str(c).strip() for c in df.columns]
     if "mgeom" not in df.columns:
         raise SystemExit(f"[FATAL] mgeom 不在列里：{df.columns.tolist()}")
 
-    feats, per_route = to_features(df)
+    gdf, per_route, bounds = to_features(df)
     # 保存 GeoJSON（可交作业）
-    fc = {"type":"FeatureCollection","features":feats}
-    Path(args.out).with_suffix(".geojson").write_text(json.dumps(fc), encoding="utf-8")
+    write_geojson(gdf, Path(args.out).with_suffix(".geojson"))
 
     # 合并图
-    make_map(per_route, args.out)
+    make_map(per_route, bounds, args.out)
 
     # 单条图（可选）
     if args.split:
-        save_split_maps(per_route, args.outdir)
+        save_split_maps(per_route, bounds, args.outdir, workers=args.workers)
 
     print(f"OK -> {args.out}（以及同名 .geojson）")
     if args.split:
@@ -1,49 +1,66 @@
 # task5_route_analysis.py
 # -*- coding: utf-8 -*-
-import json, re, argparse
+import argparse, csv, mmap
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import polars as pl
+import pyarrow.parquet as pq
 import geopandas as gpd
-from shapely import wkt
+import pyogrio
+import shapely
+from pyproj import Transformer
 import folium
 
+# 可选：orjson 解析数值数组更快，没有则退回标准库 json
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+_SNIFF_BYTES = 64 * 1024
+
 def sniff_sep(p: Path) -> str:
-    head = p.open("r", encoding="utf-8", errors="ignore").readline()
-    if ";" in head and "," not in head: return ";"
-    if "," in head and ";" not in head: return ","
-    return ","  # 两个都有时，多数是逗号
-
-def parse_edge_seq(s: str):
-    """把 cpath/opath 字段解析为 edge id 序列（尽量鲁棒）。"""
-    if not isinstance(s, str) or not s.strip():
-        return []
-    # 常见形式：'[1,2,3]'、'1,2,3'、'1|2|3'、'(1 2 3)' ——统一抽取数字
-    return [int(x) for x in re.findall(r"-?\d+", s)]
+    """在文件前 64 KB 上用 csv.Sniffer 判断分隔符；判断不了时按表头规则"""
+    with open(p, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        text = buf[:_SNIFF_BYTES].decode("utf-8", "ignore")
+    try:
+        return csv.Sniffer().sniff(text, delimiters=",;|\t").delimiter
+    except csv.Error:
+        head = text.split("\n", 1)[0]
+        if ";" in head and "," not in head: return ";"
+        return ","  # 两个都有时，多数是逗号
 
 def load_edge_lengths(edges_shp: Path) -> pd.DataFrame:
-    gdf = gpd.read_file(edges_shp)
-    if gdf.crs is None or gdf.crs.to_string().upper() in ("EPSG:4326", "WGS84", "EPSG:4269"):
-        gdfm = gdf.to_crs(3857)   # WebMercator 近似米
-    else:
-        gdfm = gdf.to_crs(3857)
-    gdf["length_m"] = gdfm.length
+    gdf = pyogrio.read_dataframe(edges_shp)   # GDAL 批量读，不走逐要素迭代
+    # WebMercator 近似米：所有坐标一次性交给 PROJ 投影，不走 gdf.to_crs 的逐几何路径
+    tr = Transformer.from_crs(gdf.crs if gdf.crs is not None else 4326, 3857, always_xy=True)
+    geoms_m = shapely.transform(gdf.geometry.values,
+                                lambda xy: np.column_stack(tr.transform(xy[:, 0], xy[:, 1])))
+    gdf["length_m"] = shapely.length(geoms_m)
     return gdf[["id", "source", "target", "geometry", "length_m"]]
 
 def build_id_time_dict(train_csv: Path, ids_needed: set, sample_interval_s=15):
-    """从 train-1500.csv 中取与 matched 同样的 id（我们当初把 id 设为原始行号）。"""
-    id2time = {}
-    df = pd.read_csv(train_csv)
-    for i, s in enumerate(df["POLYLINE"].tolist()):
-        if i not in ids_needed:
-            continue
-        try:
-            pts = json.loads(s) if isinstance(s, str) else s
-        except Exception:
-            import ast; pts = ast.literal_eval(s)
-        n = len(pts) if pts else 0
-        if n >= 2:
-            id2time[i] = (n - 1) * sample_interval_s
-    return id2time
+    """从 train-1500.csv（或预处理的 trips.parquet）中取与 matched 同样的 id（我们当初把 id 设为原始行号）。"""
+    if train_csv.suffix.lower() == ".parquet":
+        # list 列的长度就是点数
+        n_pts = pq.read_table(train_csv, columns=["lon"])["lon"].combine_chunks().value_lengths()
+        n_pts = n_pts.to_numpy(zero_copy_only=False)
+        ids = sorted({int(i) for i in ids_needed if 0 <= i < len(n_pts)})
+        return {i: (int(n_pts[i]) - 1) * sample_interval_s for i in ids if n_pts[i] >= 2}
+    df = pd.read_csv(train_csv, usecols=["POLYLINE"])
+    ids = sorted({int(i) for i in ids_needed if 0 <= i < len(df)})
+    polys = df["POLYLINE"].iloc[ids]
+    # 只需点数：'[[lon,lat],[lon,lat],...]' 的点数 = '[' 的个数 - 1（C 层 str.count，不做 JSON 解析）
+    counts = polys.str.count(r"\[").fillna(0).astype(int) - 1
+    # 抽几行核对计数是否与 JSON 解析一致（防止格式不符），不一致就退回逐行解析
+    for s, n in list(zip(polys.tolist(), counts.tolist()))[:3]:
+        if isinstance(s, str) and len(_loads(s)) != max(n, 0):
+            counts = polys.map(lambda s: len(_loads(s)) if isinstance(s, str) else 0)
+            break
+    return {i: (n - 1) * sample_interval_s for i, n in zip(ids, counts.tolist()) if n >= 2}
 
 def folium_map_for_edges(edges_gdf: gpd.GeoDataFrame, top_df: pd.DataFrame, color: str, out_html: Path, title: str):
     m = folium.Map(location=[41.15, -8.61], zoom_start=12,
@@ -68,61 +85,60 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--edges", type=Path, default=Path("edges.shp"))
     ap.add_argument("--matched", type=Path, default=Path("matched.csv"))
-    ap.add_argument("--train", type=Path, default=Path("train-1500.csv"))
+    ap.add_argument("--train", type=Path, default=Path("train-1500.csv"),
+                    help="原始轨迹 CSV，或 make_trips_parquet.py 生成的 .parquet")
     ap.add_argument("--topk", type=int, default=10)
     args = ap.parse_args()
 
     # 1) 读路网 + 边长度
     edges = load_edge_lengths(args.edges)
-    id2len = dict(zip(edges.id, edges.length_m))
+    # 边 id 排好序，之后 id -> 行号用 searchsorted（C 层二分），不做哈希 join；id 稀疏也不浪费内存
+    order = np.argsort(edges.id.to_numpy(), kind="stable")
+    sorted_ids = edges.id.to_numpy()[order].astype(np.int64)
+    sorted_len = edges.length_m.to_numpy()[order]
 
-    # 2) 读贴路结果
+    # 2) 读贴路结果（Polars 多线程解析；全部先按字符串读）
     sep = sniff_sep(args.matched)
-    mm = pd.read_csv(args.matched, sep=sep, engine="python")
-    mm.columns = [str(c).strip().strip('"').strip("'") for c in mm.columns]
+    mm = pl.read_csv(args.matched, separator=sep, infer_schema_length=0)
+    mm = mm.rename({c: c.strip() for c in mm.columns})
     use_field = "cpath" if "cpath" in mm.columns else ("opath" if "opath" in mm.columns else None)
     if not use_field:
-        raise SystemExit(f"找不到 cpath/opath 字段，现有列：{mm.columns.tolist()}")
-
-    # 3) 统计频次 & 为平均时间准备 id->route_time
-    freq = {}
-    ids_needed = set(x for x in mm.get("id", pd.Series([], dtype=int)).tolist() if pd.notna(x))
+        raise SystemExit(f"找不到 cpath/opath 字段，现有列：{mm.columns}")
+
+    # 每条轨迹一行 -> 每条路径边一行（row 区分轨迹，rid 对应 train 的行号）
+    # cpath/opath 常见形式：'[1,2,3]'、'1,2,3'、'1|2|3'、'(1 2 3)' ——统一抽取数字
+    rid = pl.col("id").cast(pl.Int64, strict=False) if "id" in mm.columns else pl.lit(None, dtype=pl.Int64)
+    long = (mm.with_row_index("row")
+              .select("row", rid.alias("rid"),
+                      pl.col(use_field).str.extract_all(r"-?\d+").cast(pl.List(pl.Int64)).alias("edges"))
+              .explode("edges")
+              .drop_nulls("edges"))
+
+    # 路径边 -> 路网行号 -> 边长（路网里没有的 id 记 0）
+    eid = long["edges"].to_numpy()
+    pos = np.searchsorted(sorted_ids, eid).clip(0, len(sorted_ids) - 1)
+    hit = sorted_ids[pos] == eid
+    long = long.with_columns(pl.Series("length_m", np.where(hit, sorted_len[pos], 0.0)))
+
+    # 3) 为平均时间准备 id->route_time
+    ids_needed = set(long["rid"].drop_nulls().unique().to_list())
     id2time = build_id_time_dict(args.train, ids_needed, sample_interval_s=15)
-
-    time_sum = {}     # 每条边累积的时间
-    time_count = {}   # 每条边被分配时间的次数（用于求平均）
-
-    for _, r in mm.iterrows():
-        path_edges = parse_edge_seq(str(r[use_field]))
-        if not path_edges:
-            continue
-        # 频次
-        for e in path_edges:
-            freq[e] = freq.get(e, 0) + 1
-
-        # 平均时间：按边长比例把该轨迹总时长分配到路径各边
-        rid = int(r["id"]) if "id" in mm.columns and pd.notna(r["id"]) else None
-        total_time = id2time.get(rid, None)
-        if total_time is None:
-            continue
-        lengths = [id2len.get(e, 0.0) for e in path_edges]
-        total_len = sum(lengths)
-        if total_len <= 0:
-            continue
-        for e, l in zip(path_edges, lengths):
-            if l <= 0:
-                continue
-            dt = total_time * (l / total_len)
-            time_sum[e] = time_sum.get(e, 0.0) + dt
-            time_count[e] = time_count.get(e, 0) + 1
-
-    # (1) 前 10 频次最高的边
-    freq_df = (pd.DataFrame([{"id": e, "freq": c} for e, c in freq.items()])
-               .sort_values("freq", ascending=False).head(args.topk))
-    # (2) 平均旅行时间最大的 10 条边（忽略从未被分配到的边）
-    avg_df = (pd.DataFrame([{"id": e, "avg_time_s": time_sum[e] / time_count[e]}
-                            for e in time_sum if time_count.get(e, 0) > 0])
-              .sort_values("avg_time_s", ascending=False).head(args.topk))
+    times = pl.DataFrame({"rid": list(id2time), "total_time": list(id2time.values())},
+                         schema={"rid": pl.Int64, "total_time": pl.Float64})
+
+    # (1) 前 10 频次最高的边（并列按 id）
+    freq_df = (long.group_by("edges").agg(pl.len().alias("freq"))
+               .sort(["freq", "edges"], descending=[True, False]).head(args.topk)
+               .rename({"edges": "id"}).to_pandas())
+    # (2) 平均旅行时间最大的 10 条边：按边长比例把该轨迹总时长分配到路径各边，
+    #     再按边求平均（忽略长度为 0 / 从未被分配到的边）
+    avg_df = (long.join(times, on="rid", how="inner")
+              .with_columns(pl.col("length_m").sum().over("row").alias("total_len"))
+              .filter((pl.col("total_len") > 0) & (pl.col("length_m") > 0))
+              .with_columns((pl.col("total_time") * pl.col("length_m") / pl.col("total_len")).alias("dt"))
+              .group_by("edges").agg(pl.col("dt").mean().alias("avg_time_s"))
+              .sort(["avg_time_s", "edges"], descending=[True, False]).head(args.topk)
+              .rename({"edges": "id"}).to_pandas())
 
     # 保存榜单
     freq_out = Path("task5_topfreq.csv"); avg_out = Path("task5_toptime.csv")
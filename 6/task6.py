@@ -2,36 +2,80 @@
 # -*- coding: utf-8 -*-
 """
 Task 6 (Bonus): Map Matching Quality Analysis - Simplified Version
-No GDAL/Fiona dependency - Uses only pandas, shapely, folium
+No GDAL/Fiona dependency - Uses pandas, pyarrow, shapely, pyproj, folium
+(numba and orjson are optional speedups)
 """
 
-import json, re, argparse, warnings
+import csv, json, mmap, re, argparse, warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import shapely
 from shapely import wkt
-from shapely.geometry import Point, LineString, MultiLineString
-from shapely.ops import nearest_points
+from shapely.geometry import LineString, MultiLineString
+from pyproj import Transformer
 import folium
 import numpy as np
 
 warnings.filterwarnings('ignore')
 
+# Optional: orjson is a faster C decoder for the POLYLINE arrays; fall back to json
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# Optional: with numba the point-to-route distance runs as a JIT kernel;
+# without it GEOS (shapely.distance) does the work
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# WGS84 lon/lat -> Portugal TM06 (EPSG:3763), planar meters around Porto
+TO_METERS = Transformer.from_crs(4326, 3763, always_xy=True)
+
+
+_SNIFF_BYTES = 64 * 1024
+
 
 def sniff_sep(p: Path) -> str:
-    """Detect CSV separator"""
-    with open(p, "r", encoding="utf-8", errors="ignore") as f:
-        head = f.readline()
-    if ";" in head and "," not in head:
-        return ";"
-    if "," in head and ";" not in head:
+    """Detect CSV separator with csv.Sniffer on the first 64 KB (mmap)"""
+    with open(p, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        text = buf[:_SNIFF_BYTES].decode("utf-8", "ignore")
+    try:
+        return csv.Sniffer().sniff(text, delimiters=",;|\t").delimiter
+    except csv.Error:
+        head = text.split("\n", 1)[0]
+        if ";" in head and "," not in head:
+            return ";"
         return ","
-    return ","
+
+
+_TRAIL_COMMA = re.compile(r',\s*\)')   # "..., )" -> "...)"
 
 
 def parse_geom_safe(wkt_text):
     """Parse WKT geometry string safely"""
     if not isinstance(wkt_text, str):
         return None
+    # Fast path: clean WKT parses as-is, no strip/regex work
+    try:
+        g = wkt.loads(wkt_text)
+        return None if g.is_empty else g
+    except Exception:
+        pass
     s = wkt_text.strip().strip('"').strip("'")
     if not s or s.upper().endswith("EMPTY"):
         return None
@@ -39,171 +83,269 @@ def parse_geom_safe(wkt_text):
         return wkt.loads(s)
     except Exception:
         # Fix common WKT issues
-        s2 = re.sub(r',\s*\)', ')', s)
         try:
-            return wkt.loads(s2)
+            return wkt.loads(_TRAIL_COMMA.sub(')', s))
         except Exception:
             return None
 
 
+def parse_geoms(wkts) -> np.ndarray:
+    """Parse a whole WKT column in one GEOS call; only failed rows retry parse_geom_safe"""
+    txt = (pd.Series(wkts, dtype=object).fillna("").astype(str)
+           .str.strip().str.strip('"').str.strip("'"))
+    geoms = shapely.from_wkt(txt.to_numpy(), on_invalid="ignore")
+    geoms[shapely.is_empty(geoms)] = None
+    for i in np.flatnonzero(shapely.is_missing(geoms) & (txt != "").to_numpy()):
+        geoms[i] = parse_geom_safe(txt.iat[i])
+    return geoms
+
+
 def load_original_gps(train_csv: Path, max_trips=None):
-    """Load original GPS trajectories from train.csv"""
-    df = pd.read_csv(train_csv)
+    """Load original GPS trajectories from train.csv (cached per file/max_trips)"""
+    return _load_original_gps(Path(train_csv).resolve(), max_trips)
+
+
+@lru_cache(maxsize=4)
+def _load_original_gps(train_csv: Path, max_trips):
+    # Only POLYLINE is needed (row number = trip id). A full read goes through
+    # the multithreaded Arrow parser; with max_trips the C parser stops early
     if max_trips:
-        df = df.head(max_trips)
+        df = pd.read_csv(train_csv, usecols=["POLYLINE"], nrows=max_trips)
+    else:
+        df = pd.read_csv(train_csv, usecols=["POLYLINE"], engine="pyarrow")
 
     gps_data = {}
-    for idx, row in df.iterrows():
-        polyline_str = row.get("POLYLINE", "")
-        if not polyline_str or pd.isna(polyline_str):
+    for idx, polyline_str in zip(df.index.tolist(), df["POLYLINE"].tolist()):
+        if not isinstance(polyline_str, (str, bytes)) or not polyline_str:
             continue
 
         try:
-            pts = json.loads(polyline_str) if isinstance(polyline_str, str) else polyline_str
-        except:
+            pts = _loads(polyline_str)
+        except Exception:
             try:
                 import ast
                 pts = ast.literal_eval(polyline_str)
-            except:
+            except Exception:
                 continue
+        if not pts or len(pts) < 2:
+            continue
 
-        if pts and len(pts) >= 2:
-            valid_pts = []
-            for p in pts:
-                if isinstance(p, (list, tuple)) and len(p) == 2:
-                    lon, lat = float(p[0]), float(p[1])
-                    if -180 <= lon <= 180 and -90 <= lat <= 90:
-                        valid_pts.append((lon, lat))
-            if len(valid_pts) >= 2:
-                gps_data[idx] = valid_pts
+        try:
+            a = np.asarray(pts, dtype=np.float64)
+        except (TypeError, ValueError):
+            # Ragged input: keep only well-formed [lon, lat] pairs
+            a = np.asarray([p for p in pts if isinstance(p, (list, tuple)) and len(p) == 2],
+                           dtype=np.float64).reshape(-1, 2)
+        if a.ndim != 2 or a.shape[1] != 2:
+            continue
+        # Validate all points in one vectorized pass; store (M, 2) [lon, lat] arrays
+        a = a[(np.abs(a[:, 0]) <= 180) & (np.abs(a[:, 1]) <= 90)]
+        if len(a) >= 2:
+            gps_data[idx] = a
 
     return gps_data
 
 
-def calculate_matching_quality(gps_points, matched_geom):
+def to_meters(geoms):
+    """Project lon/lat geometries (scalar or array) into EPSG:3763 in one PROJ call"""
+    return shapely.transform(
+        geoms, lambda xy: np.column_stack(TO_METERS.transform(xy[:, 0], xy[:, 1])))
+
+
+@njit(cache=True)
+def min_dist_to_segments(px, py, sx, sy, seg_ok):
+    """Planar distance from each point to the nearest route segment (j, j+1) with seg_ok[j]"""
+    out = np.empty(px.shape[0])
+    for i in range(px.shape[0]):
+        best = np.inf
+        for j in range(sx.shape[0] - 1):
+            if not seg_ok[j]:
+                continue
+            dx = sx[j + 1] - sx[j]
+            dy = sy[j + 1] - sy[j]
+            l2 = dx * dx + dy * dy
+            t = 0.0
+            if l2 > 0:
+                t = ((px[i] - sx[j]) * dx + (py[i] - sy[j]) * dy) / l2
+                t = min(max(t, 0.0), 1.0)
+            ex = sx[j] + t * dx - px[i]
+            ey = sy[j] + t * dy - py[i]
+            d2 = ex * ex + ey * ey
+            if d2 < best:
+                best = d2
+        out[i] = np.sqrt(best)
+    return out
+
+
+# An STRtree nearest lookup only pays off once points x segments is large;
+# measured crossover ~2M against the numba kernel, ~200k against plain GEOS
+STRTREE_MIN_WORK = 2_000_000 if HAS_NUMBA else 200_000
+
+
+def point_distances(gps_points, geom_m):
+    """Distance (m) from every GPS point to the already projected matched route"""
+    # Project GPS points into EPSG:3763 so distances are meters
+    arr = np.asarray(gps_points, dtype=np.float64).reshape(-1, 2)
+    xs, ys = TO_METERS.transform(arr[:, 0], arr[:, 1])
+    # Route vertices once; segments never bridge two parts of a MultiLineString
+    xy, part = shapely.get_coordinates(shapely.get_parts(geom_m), return_index=True)
+    seg_ok = part[1:] == part[:-1]
+    seg_start = np.flatnonzero(seg_ok)
+
+    work = len(arr) * len(seg_start)
+    if HAS_NUMBA and len(seg_start) and work < STRTREE_MIN_WORK:
+        distances = min_dist_to_segments(np.asarray(xs), np.asarray(ys),
+                                         np.ascontiguousarray(xy[:, 0]),
+                                         np.ascontiguousarray(xy[:, 1]), seg_ok)
+    elif work >= STRTREE_MIN_WORK:
+        # One 2-point LineString per segment; nearest segment + distance per point
+        segs = shapely.linestrings(np.stack([xy[seg_start], xy[seg_start + 1]], axis=1))
+        pts = shapely.points(xs, ys)
+        (pt_idx, _), dists = shapely.STRtree(segs).query_nearest(
+            pts, return_distance=True, all_matches=False)
+        distances = np.full(len(pts), np.nan)
+        distances[pt_idx] = dists
+    else:
+        # One vectorized GEOS call for all points; distance() is already the
+        # minimum distance, so no nearest_points needed
+        distances = shapely.distance(shapely.points(xs, ys), geom_m)
+    distances[np.isnan(distances)] = 999
+    return distances
+
+
+def calculate_matching_quality(gps_list, geoms, workers=1):
     """
-    Calculate quality metrics:
+    Calculate quality metrics for all trips at once (dict of per-trip arrays):
     1. Average distance from GPS to matched route (meters)
     2. Coverage ratio (points within 50m threshold)
     3. Route continuity score
+    Trips without a route or GPS points get the worst scores.
     """
-    if matched_geom is None or not gps_points:
-        return {
-            'avg_distance': 999,
-            'max_distance': 999,
-            'coverage': 0.0,
-            'continuity': 0.0,
-            'quality_score': 0.0,
-            'num_gps_points': len(gps_points),
-            'route_length': 0
-        }
-
-    # Calculate distances (approximate: 1 degree ≈ 111km)
-    distances = []
-    for lon, lat in gps_points:
-        pt = Point(lon, lat)
-        try:
-            nearest = nearest_points(pt, matched_geom)[1]
-            # Convert degrees to meters (approximate)
-            dist = pt.distance(nearest) * 111000
-            distances.append(dist)
-        except:
-            distances.append(999)
-
-    avg_dist = np.mean(distances) if distances else 999
-    max_dist = np.max(distances) if distances else 999
-
-    # Coverage: percentage within 50m
-    within_threshold = sum(1 for d in distances if d < 50)
-    coverage = within_threshold / len(distances) if distances else 0
-
-    # Continuity: check if matched route is continuous
-    continuity = 1.0
-    if isinstance(matched_geom, MultiLineString):
-        # Penalize fragmented routes
-        continuity = 1.0 / len(matched_geom.geoms)
-
-    # Route length
-    route_length = matched_geom.length * 111000  # Convert to meters
+    n = len(geoms)
+    geoms = np.asarray(geoms, dtype=object)
+    num_pts = np.fromiter((len(g) for g in gps_list), dtype=np.int64, count=n)
+    ok = np.flatnonzero(~shapely.is_missing(geoms) & (num_pts > 0))
+
+    # Route geometry properties for all trips at once (C loops over the array)
+    geoms_m = to_meters(geoms)
+    lengths = shapely.length(geoms_m)
+    num_parts = shapely.get_num_geometries(geoms)
+    is_multi = shapely.get_type_id(geoms) == 5      # MultiLineString
+
+    # Per-point distances of all trips in one preallocated flat buffer
+    # (trip k owns flat[starts[k]:starts[k] + sizes[k]]). float32 is plenty
+    # for meters reported to 2 decimals and halves the memory traffic of the
+    # reductions; int16 cm would clip at 327 m, real errors go beyond that
+    sizes = num_pts[ok]
+    starts = np.cumsum(sizes) - sizes
+    flat = np.empty(int(sizes.sum()), dtype=np.float32)
+
+    # Trips are independent, so they can be spread over processes (opt-in:
+    # each spawned worker re-imports pandas/pyarrow/numba/pyproj, which costs
+    # more than scoring the bundled data sequentially); each result is copied
+    # into its slice as it arrives
+    args = ([gps_list[i] for i in ok], geoms_m[ok].tolist())
+    if workers is None or workers <= 1:
+        for k, d in zip(starts.tolist(), map(point_distances, *args)):
+            flat[k:k + len(d)] = d
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            for k, d in zip(starts.tolist(), ex.map(point_distances, *args, chunksize=256)):
+                flat[k:k + len(d)] = d
+
+    # Metric columns (SoA), worst-case defaults for trips without route/GPS
+    avg_dist = np.full(n, 999.0)
+    max_dist = np.full(n, 999.0)
+    coverage = np.zeros(n)
+    continuity = np.zeros(n)
+    route_length = np.zeros(n)
+    if len(ok):
+        # Every summary is a single reduceat over all trips
+        avg_dist[ok] = np.add.reduceat(flat, starts, dtype=np.float64) / sizes
+        max_dist[ok] = np.maximum.reduceat(flat, starts)
+        # Coverage: percentage within 50m
+        coverage[ok] = np.add.reduceat((flat < 50).astype(np.int64), starts) / sizes
+        # Continuity: penalize fragmented (MultiLineString) routes
+        continuity[ok] = np.where(is_multi[ok], 1.0 / np.maximum(num_parts[ok], 1), 1.0)
+        route_length[ok] = lengths[ok]
 
     # Combined quality score (0-1)
     # Penalize: high avg distance, low coverage, fragmentation
-    distance_score = max(0, 1 - avg_dist / 100)  # 100m as reference
-    quality_score = (0.5 * distance_score +
-                     0.4 * coverage +
-                     0.1 * continuity)
+    distance_score = np.maximum(0, 1 - avg_dist / 100)  # 100m as reference
+    quality_score = np.zeros(n)
+    quality_score[ok] = (0.5 * distance_score[ok] +
+                         0.4 * coverage[ok] +
+                         0.1 * continuity[ok])
 
     return {
-        'avg_distance': round(avg_dist, 2),
-        'max_distance': round(max_dist, 2),
-        'coverage': round(coverage, 3),
-        'continuity': round(continuity, 3),
-        'quality_score': round(quality_score, 3),
-        'num_gps_points': len(gps_points),
-        'route_length': round(route_length, 1)
+        'avg_distance': avg_dist.round(2),
+        'max_distance': max_dist.round(2),
+        'coverage': coverage.round(3),
+        'continuity': continuity.round(3),
+        'quality_score': quality_score.round(3),
+        'num_gps_points': num_pts,
+        'route_length': route_length.round(1)
     }
 
 
-def identify_poor_matches(matched_csv: Path, train_csv: Path,
-                          threshold=0.6, max_trips=None):
-    """Identify trips with poor matching quality"""
-    print(f"Loading matched results from: {matched_csv}")
+def load_matched(matched_csv: Path, max_trips=None) -> pd.DataFrame:
+    """Read matched results and parse mgeom once into a '_geom' column"""
     sep = sniff_sep(matched_csv)
-    df_matched = pd.read_csv(matched_csv, sep=sep, engine="python")
-    df_matched.columns = [str(c).strip().strip('"').strip("'")
-                          for c in df_matched.columns]
+    # Single-character separator: the C parser handles it (much faster than engine="python")
+    df_matched = pd.read_csv(matched_csv, sep=sep, engine="c")
+    df_matched.columns = (df_matched.columns.astype(str).str.strip()
+                          .str.strip('"').str.strip("'"))
 
     if max_trips:
-        df_matched = df_matched.head(max_trips)
+        df_matched = df_matched.head(max_trips).copy()
 
-    print(f"Loading original GPS data from: {train_csv}")
-    gps_data = load_original_gps(train_csv, max_trips)
+    df_matched['_geom'] = parse_geoms(df_matched['mgeom'].to_numpy()
+                                      if 'mgeom' in df_matched.columns else [None] * len(df_matched))
+    return df_matched
 
-    print(f"\nAnalyzing {len(df_matched)} trips...")
 
-    results = []
-    for idx, row in df_matched.iterrows():
-        trip_id = row.get('id', idx)
-        matched_geom_str = str(row.get('mgeom', ''))
-        matched_geom = parse_geom_safe(matched_geom_str)
-        gps_points = gps_data.get(trip_id, [])
-
-        metrics = calculate_matching_quality(gps_points, matched_geom)
-
-        # Classify quality
-        q_score = metrics['quality_score']
-        if q_score >= 0.8:
-            quality_class = "Excellent"
-        elif q_score >= threshold:
-            quality_class = "Good"
-        elif q_score >= 0.4:
-            quality_class = "Fair"
-        else:
-            quality_class = "Poor"
-
-        results.append({
-            'trip_id': trip_id,
-            'quality_class': quality_class,
-            'is_poor': q_score < threshold,
-            **metrics
-        })
-
-    df_results = pd.DataFrame(results)
+def trip_ids(df_matched: pd.DataFrame) -> list:
+    """Trip id per row: the 'id' column, or the row position when absent"""
+    return (df_matched['id'] if 'id' in df_matched.columns else df_matched.index).tolist()
+
+
+def identify_poor_matches(df_matched: pd.DataFrame, gps_data: dict,
+                          threshold=0.6, max_trips=None, workers=1):
+    """Identify trips with poor matching quality (df_matched from load_matched)"""
+    if max_trips:
+        df_matched = df_matched.head(max_trips)
+
+    print(f"\nAnalyzing {len(df_matched)} trips...")
+    ids = trip_ids(df_matched)
+    gps = [gps_data.get(t, ()) for t in ids]
+    metrics = calculate_matching_quality(gps, df_matched['_geom'].to_numpy(), workers)
+
+    # Classify quality in one vectorized pass (first matching rule wins, so
+    # any threshold works, also outside 0.4..0.8)
+    q_score = metrics['quality_score']
+    poor_mask = q_score < threshold
+    quality_class = np.select([q_score >= 0.8, q_score >= threshold, q_score >= 0.4],
+                              ["Excellent", "Good", "Fair"], default="Poor")
+    df_results = pd.DataFrame({
+        'trip_id': np.asarray(ids),
+        'quality_class': quality_class,
+        'is_poor': poor_mask,
+        **metrics,
+    })
 
     # Summary statistics
-    poor_matches = df_results[df_results['is_poor']]
-    excellent = df_results[df_results['quality_class'] == 'Excellent']
-    good = df_results[df_results['quality_class'] == 'Good']
-    fair = df_results[df_results['quality_class'] == 'Fair']
+    poor_matches = df_results[poor_mask]
+    counts = df_results['quality_class'].value_counts()
+    excellent, good, fair = (int(counts.get(c, 0)) for c in ("Excellent", "Good", "Fair"))
 
     print(f"\n{'=' * 70}")
     print(f"MAP MATCHING QUALITY ANALYSIS REPORT")
     print(f"{'=' * 70}")
     print(f"\nTotal trips analyzed: {len(df_results)}")
     print(f"\nQuality Distribution:")
-    print(f"  Excellent (≥0.8): {len(excellent):3d} ({len(excellent) / len(df_results) * 100:5.1f}%)")
-    print(f"  Good (≥{threshold}):      {len(good):3d} ({len(good) / len(df_results) * 100:5.1f}%)")
-    print(f"  Fair (≥0.4):      {len(fair):3d} ({len(fair) / len(df_results) * 100:5.1f}%)")
+    print(f"  Excellent (≥0.8): {excellent:3d} ({excellent / len(df_results) * 100:5.1f}%)")
+    print(f"  Good (≥{threshold}):      {good:3d} ({good / len(df_results) * 100:5.1f}%)")
+    print(f"  Fair (≥0.4):      {fair:3d} ({fair / len(df_results) * 100:5.1f}%)")
     print(f"  Poor (<{threshold}):      {len(poor_matches):3d} ({len(poor_matches) / len(df_results) * 100:5.1f}%)")
 
     print(f"\nOverall Metrics:")
@@ -232,29 +374,37 @@ def identify_poor_matches(matched_csv: Path, train_csv: Path,
     return df_results, poor_matches
 
 
-def visualize_comparison(matched_csv: Path, train_csv: Path,
-                         trip_id: int, out_html: Path):
-    """Create comparison map: GPS points vs matched route"""
-    sep = sniff_sep(matched_csv)
-    df_matched = pd.read_csv(matched_csv, sep=sep, engine="python")
-    df_matched.columns = [str(c).strip().strip('"').strip("'")
-                          for c in df_matched.columns]
+# Map styles shared by every comparison map
+GPS_MARKER_KW = dict(radius=4, color='red', fill=True, fillColor='red', fillOpacity=0.7)
+START_ICON_KW = dict(color='green', icon='play')
+END_ICON_KW = dict(color='red', icon='stop')
 
-    # Load GPS and matched route
-    gps_data = load_original_gps(train_csv)
-    gps_points = gps_data.get(trip_id, [])
 
-    if 'id' in df_matched.columns:
-        row = df_matched[df_matched['id'] == trip_id].iloc[0]
-    else:
-        row = df_matched.iloc[trip_id]
+def write_results(df: pd.DataFrame, out_csv: Path, parquet=False):
+    """Write a results table with Arrow's C++ CSV writer (optionally also .parquet)"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with open(out_csv, "wb") as f:
+        # Plain header line (Arrow would quote the column names); values
+        # never contain commas or quotes, so no quoting needed
+        f.write((",".join(table.column_names) + "\n").encode("utf-8"))
+        pacsv.write_csv(table, f, write_options=pacsv.WriteOptions(
+            include_header=False, quoting_style="none"))
+    if parquet:
+        pq.write_table(table, out_csv.with_suffix(".parquet"), compression="zstd")
+
 
-    matched_geom = parse_geom_safe(str(row.get('mgeom', '')))
+def visualize_comparison(geom_by_id: dict, gps_data: dict,
+                         trip_id: int, out_html: Path):
+    """Create comparison map: GPS points vs matched route"""
+    # Look up the pre-parsed matched route and GPS points
+    if trip_id not in geom_by_id:
+        raise KeyError(f"trip {trip_id} not in matched results")
+    matched_geom = geom_by_id[trip_id]
+    gps_points = gps_data.get(trip_id, ())
 
     # Calculate center
-    if gps_points:
-        center_lat = np.mean([lat for _, lat in gps_points])
-        center_lon = np.mean([lon for lon, _ in gps_points])
+    if len(gps_points):
+        center_lon, center_lat = gps_points.mean(axis=0).tolist()
     else:
         center_lat, center_lon = 41.15, -8.61
 
@@ -265,22 +415,24 @@ def visualize_comparison(matched_csv: Path, train_csv: Path,
         tiles="CartoDB positron"
     )
 
-    # Add GPS points with sequence numbers
-    for i, (lon, lat) in enumerate(gps_points):
-        folium.CircleMarker(
-            [lat, lon],
-            radius=4,
-            color='red',
-            fill=True,
-            fillColor='red',
-            fillOpacity=0.7,
-            popup=f"GPS Point {i + 1}",
-            tooltip=f"Point {i + 1}"
+    # Add GPS points with sequence numbers: one GeoJSON layer, each point
+    # drawn from a single CircleMarker template
+    if len(gps_points):
+        features = [{'type': 'Feature',
+                     'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+                     'properties': {'popup': f"GPS Point {i + 1}", 'tooltip': f"Point {i + 1}"}}
+                    for i, (lon, lat) in enumerate(np.asarray(gps_points).tolist())]
+        folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': features},
+            name="GPS Points",
+            marker=folium.CircleMarker(**GPS_MARKER_KW),
+            popup=folium.GeoJsonPopup(fields=['popup'], labels=False),
+            tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False)
         ).add_to(m)
 
     # Add GPS trajectory line
     if len(gps_points) >= 2:
-        gps_line = [(lat, lon) for lon, lat in gps_points]
+        gps_line = gps_points[:, ::-1].tolist()   # (lat, lon) for Leaflet
         folium.PolyLine(
             gps_line,
             color='red',
@@ -313,18 +465,18 @@ def visualize_comparison(matched_csv: Path, train_csv: Path,
                 ).add_to(m)
 
     # Add start and end markers
-    if gps_points:
+    if len(gps_points):
         # Start (green)
         folium.Marker(
             [gps_points[0][1], gps_points[0][0]],
             popup="Start",
-            icon=folium.Icon(color='green', icon='play')
+            icon=folium.Icon(**START_ICON_KW)
         ).add_to(m)
         # End (red)
         folium.Marker(
             [gps_points[-1][1], gps_points[-1][0]],
             popup="End",
-            icon=folium.Icon(color='red', icon='stop')
+            icon=folium.Icon(**END_ICON_KW)
         ).add_to(m)
 
     # Add legend
@@ -360,6 +512,11 @@ def main():
                         help="Maximum number of trips to analyze (for testing)")
     parser.add_argument("--out", type=Path, default=Path("quality_analysis.csv"),
                         help="Output CSV with quality metrics")
+    parser.add_argument("--parquet", action="store_true",
+                        help="Also write the outputs as .parquet next to the CSVs")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes for scoring (default: 1 = sequential; "
+                             "only worth it for very large inputs)")
     parser.add_argument("--visualize", type=int, nargs='*',
                         help="Trip IDs to visualize (space-separated)")
     args = parser.parse_args()
@@ -372,18 +529,26 @@ def main():
         print(f"Error: Train file not found: {args.train}")
         return
 
+    # Sniff/read/parse matched.csv once and load GPS data once; both are
+    # reused by the comparison maps below. Maps may show any trip, so with
+    # --visualize all matched rows are parsed
+    print(f"Loading matched results from: {args.matched}")
+    df_matched = load_matched(args.matched, None if args.visualize else args.max_trips)
+    print(f"Loading original GPS data from: {args.train}")
+    gps_data = load_original_gps(args.train, args.max_trips)
+
     # Analyze quality
     df_results, poor_matches = identify_poor_matches(
-        args.matched, args.train, args.threshold, args.max_trips
+        df_matched, gps_data, args.threshold, args.max_trips, args.workers
     )
 
     # Save results
-    df_results.to_csv(args.out, index=False)
+    write_results(df_results, args.out, args.parquet)
     print(f"\n✓ Saved quality analysis: {args.out}")
 
     if len(poor_matches) > 0:
         poor_file = args.out.with_name("poor_matches.csv")
-        poor_matches.to_csv(poor_file, index=False)
+        write_results(poor_matches, poor_file, args.parquet)
         print(f"✓ Saved poor matches: {poor_file}")
 
     # Visualize if requested
@@ -391,10 +556,16 @@ def main():
         out_dir = Path("comparison_maps")
         out_dir.mkdir(exist_ok=True)
         print(f"\nGenerating comparison maps...")
+        # Lookup for all requested trips; on duplicate ids the first row wins
+        geom_by_id = {}
+        for tid, g in zip(trip_ids(df_matched), df_matched['_geom'].tolist()):
+            geom_by_id.setdefault(tid, g)
+        # Maps may show any trip: full GPS data (no reload unless --max-trips was set)
+        gps_data = load_original_gps(args.train)
         for trip_id in args.visualize:
             try:
                 out_file = out_dir / f"trip_{trip_id}_comparison.html"
-                visualize_comparison(args.matched, args.train, trip_id, out_file)
+                visualize_comparison(geom_by_id, gps_data, trip_id, out_file)
             except Exception as e:
                 print(f"✗ Error visualizing trip {trip_id}: {e}")
 
@@ -0,0 +1,76 @@
+# make_trips_parquet.py
+# -*- coding: utf-8 -*-
+# 一次性预处理：train-1500.csv -> trips.parquet
+# 列：trip_id: string, lon: list<float64>, lat: list<float64>（行顺序与 CSV 一致，行号即 id）
+# 之后各脚本直接读 Parquet，不再重复解析 POLYLINE 的 JSON 文本
+import argparse
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+# 可选：orjson 解析数值数组更快，没有则退回标准库 json
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+
+def _parse_polyline(s):
+    """POLYLINE 是 JSON 字符串：[[lon,lat], ...] -> (M,2) float64 数组（坏数据 -> 空数组）"""
+    if not isinstance(s, str):
+        return np.empty((0, 2))
+    try:
+        pts = _loads(s)
+    except Exception:
+        import ast
+        pts = ast.literal_eval(s)
+    # 与 3/02_build_trips.py 的 _as_array 一致：常规情况一次转成 (M,2)；
+    # 形状不对（参差不齐、每点不是 2 个值）时逐点挑出合法的 [lon,lat]，不用 reshape 硬凑
+    try:
+        arr = np.asarray(pts, dtype=np.float64)
+    except (TypeError, ValueError):
+        arr = None
+    if arr is None or arr.ndim != 2 or arr.shape[1] != 2:
+        ok = [p for p in pts
+              if isinstance(p, (list, tuple)) and len(p) == 2
+              and all(isinstance(v, (int, float)) for v in p)]
+        arr = np.asarray(ok, dtype=np.float64) if ok else np.empty((0, 2))
+    return arr
+
+
+def build_table(csv_file: Path) -> pa.Table:
+    src = pacsv.read_csv(csv_file, convert_options=pacsv.ConvertOptions(
+        include_columns=["TRIP_ID", "POLYLINE"],
+        column_types={"TRIP_ID": pa.string(), "POLYLINE": pa.string()}))
+    arrs = [_parse_polyline(s) for s in src["POLYLINE"].to_pylist()]
+    # 经纬度各一个扁平缓冲区 + 共享 offsets，直接拼成 Arrow list 列
+    offsets = pa.array(np.concatenate([[0], np.cumsum([len(a) for a in arrs])]), type=pa.int32())
+    flat = np.concatenate(arrs) if arrs else np.empty((0, 2))
+    return pa.table({
+        "trip_id": src["TRIP_ID"],
+        "lon": pa.ListArray.from_arrays(offsets, pa.array(flat[:, 0])),
+        "lat": pa.ListArray.from_arrays(offsets, pa.array(flat[:, 1])),
+    })
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--csv", type=Path, default=Path("train-1500.csv"))
+    ap.add_argument("--out", type=Path, default=Path("trips.parquet"))
+    args = ap.parse_args()
+
+    table = build_table(args.csv)
+    pq.write_table(table, args.out, compression="zstd")
+    print("Wrote", args.out.resolve(), "trips:", table.num_rows)
+
+
+if __name__ == "__main__":
+    main()
+
+# python make_trips_parquet.py --csv ./train-1500.csv --out ./trips.parquet
+# 各任务目录各有一份 train-1500.csv，对应生成到该目录即可，例如：
+# python make_trips_parquet.py --csv ./5/train-1500.csv --out ./5/trips.parquet